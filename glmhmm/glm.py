@@ -12,6 +12,7 @@ from scipy import optimize
 from autograd import value_and_grad, hessian
 from warnings import simplefilter
 import glmhmm.observations as obs
+from glmhmm.utils import variance_from_hessian
 
 class GLM(object):
     
@@ -124,7 +125,7 @@ class GLM(object):
         ----------
         x : nxd array of the data (design matrix)
         w : dxc array of weights
-        y : nxc 1/0 array of observations
+        y : nxc 1/0 array of observations, or nx1 vector of integer observation indices
         reshape_weights : boolean, optional. Sets whether or not to reshape weights and add column of ones to phi. 
             The default is False. Typically only True if weights have been flattened prior to calling function, e.g.
             in advance of performing gradient descent. 
@@ -147,7 +148,10 @@ class GLM(object):
             phi = np.hstack((np.ones((len(phi),1)),phi))
             
         norm = np.sum(phi,axis=1) # get normalization constant 
-        weightedObs = np.sum(np.multiply(phi,y),axis=1)
+        if y.ndim == 1:
+            weightedObs = phi[np.arange(y.shape[0]),y] # gather the probability of each observed class
+        else:
+            weightedObs = np.sum(np.multiply(phi,y),axis=1)
         log_pyx = np.log(weightedObs) - np.log(norm) # compute loglikelihood
         
         assert np.round(np.sum(np.divide(phi.T,norm),axis=0),3).all()==1, 'Sum of normalized probabilities does not equal 1!'
@@ -166,7 +170,7 @@ class GLM(object):
         ----------
         x : nxd array of the data (design matrix)
         w : dxc array of weights
-        y : nxc 1/0 array of observations
+        y : nxc 1/0 array of observations, or nx1 vector of integer observation indices
         compHess : boolean, optional
             sets whether or not to compute the Hessian of the weight matrix. The default is False.
         gammas : vector of floats, optional
@@ -184,14 +188,114 @@ class GLM(object):
         simplefilter(action='ignore', category=FutureWarning) # ignore FutureWarning generated by scipy
         OptimizeResult = optimize.minimize(value_and_grad(opt_log),w_flat, jac = "True", method = "L-BFGS-B")
        
-        self.w = np.hstack((np.zeros((self.d,1)),np.reshape(OptimizeResult.x,(self.d,self.c-1)))) # reshape and update weights
-        # Get updated observation probabilities 
-        self.phi = self.observations.compObs(x,w) 
+        # keep results local until the end so concurrent calls (e.g. one per HMM state) return their own values
+        w_new = np.hstack((np.zeros((self.d,1)),np.reshape(OptimizeResult.x,(self.d,self.c-1)))) # reshape and update weights
+        # Get updated observation probabilities from the fitted weights, so callers can reuse them directly
+        phi = self.observations.compObs(x,w_new) 
         
         if compHess:
             ## compute Hessian
             hess = hessian(opt_log) # function that computes the hessian
-            H = hess(self.w[:,1:]) # gets matrix for w_hats
+            H = hess(w_new[:,1:]) # gets matrix for w_hats
             self.variance = np.sqrt(np.diag(np.linalg.inv(H.T.reshape((self.d * (self.c-1),self.d * (self.c-1)))))) # calculate variance of weights from Hessian
         
-        return self.w,self.phi
\ No newline at end of file
+        self.w, self.phi = w_new, phi
+        
+        return w_new,phi
+    
+    def fitBatch(self,x,w,y,gammas,compHess=False,gaussianPrior=0,maxiter=50,tol=1e-6,logits=None):
+        """
+        Fits k weighted GLMs at once with Newton's method (iteratively reweighted least squares), one for each column 
+        of gammas. Minimizes the same weighted loss as fit, but the gradients, Hessians and Newton steps of all k 
+        problems are computed together with batched array operations instead of k separate optimizations. 
+        Parameters
+        ----------
+        x : nxd array of the data (design matrix)
+        w : kxdxc array of initial weights (the first column of each dxc block is held at zero)
+        y : nx1 vector of integer observation indices
+        gammas : nxk array of weighting factors on the loglikelihood, one column per set of weights
+        compHess : boolean, optional
+            sets whether or not to compute the variance of the weights from the Hessian. The default is False.
+        gaussianPrior : float, optional. 
+            Sets the inverse variance of the Gaussian prior on the loglikelihood function. Default is 0, equivalent to no prior. 
+        maxiter : int, optional
+            The maximum number of Newton steps. The default is 50.
+        tol : float, optional
+            Stops early once the largest weight update falls below this value. The default is 1e-6.
+        logits : nxkxc array, optional
+            Precomputed products of x with the initial weights, e.g. cached by the caller from the previous E step. 
+            Saves recomputing them for the first Newton step. The default is None, in which case they are computed here.
+        Returns
+        -------
+        w_new : kxdxc array of updated weights
+        phi : nxkxc array of the observation probabilities computed from the updated weights
+        logits : nxkxc array of the products of x with the updated weights, so the caller can reuse them
+        """
+        
+        k, p = w.shape[0], self.d * (self.c-1) # number of weight sets and free weights in each
+        lam = gaussianPrior**2 # matches the prior term in neglogli
+        rows = np.arange(y.shape[0])
+        
+        def objective(w,logits=None):
+            # weighted negative loglikelihood of each set of weights, the observation probabilities and the logits
+            if logits is None:
+                logits = np.tensordot(x,w,axes=([1],[1])) # nxkxc
+            m = logits.max(axis=2,keepdims=True)
+            lognorm = m + np.log(np.sum(np.exp(logits - m),axis=2,keepdims=True))
+            phi = np.exp(logits - lognorm)
+            loss = -np.sum(gammas * (logits[rows,:,y] - lognorm[:,:,0]),axis=0) + lam/2 * np.sum(w[:,:,1:]**2,axis=(1,2))
+            return loss, phi, logits
+        
+        def gradHess(w,phi):
+            # gradient and Hessian of the loss with respect to the free weights of each set
+            resid = phi.copy()
+            resid[rows,:,y] -= 1 # phi - one-hot(y) without building the one-hot matrix
+            grad = np.tensordot(x,gammas[:,:,np.newaxis] * resid[:,:,1:],axes=([0],[0])).transpose((1,0,2)) + lam * w[:,:,1:]
+            
+            # sum_t gamma_t (diag(p_t) - p_t p_t^T) kron x_t x_t^T for every set, one dxd block per pair of classes (a,b).
+            # each block is a weighted x^T x, so the only temporaries are nxk weights and an nxd scaled copy of x
+            P = phi[:,:,1:]
+            H = np.empty((k,self.d,self.c-1,self.d,self.c-1))
+            for a in range(self.c-1):
+                for b in range(a,self.c-1):
+                    m = gammas * P[:,:,a] * ((a == b) - P[:,:,b]) # nxk weights of block (a,b)
+                    for zk in range(k):
+                        H[zk,:,a,:,b] = (x.T * m[:,zk]) @ x
+                        H[zk,:,b,:,a] = H[zk,:,a,:,b] # the Hessian is symmetric
+            H = H.reshape((k,p,p)) + lam * np.eye(p)
+            return grad.reshape((k,p,1)), H
+        
+        w = np.array(w,dtype=float)
+        loss, phi, logits = objective(w,logits)
+        
+        for i in range(maxiter):
+            grad, H = gradHess(w,phi)
+            try:
+                step = np.linalg.solve(H,grad) # all k Newton steps in one batched solve
+            except np.linalg.LinAlgError:
+                step = np.linalg.pinv(H) @ grad # e.g. a state with no posterior weight and no prior
+            step = step.reshape((k,self.d,self.c-1))
+            
+            # halve the step of any set of weights whose loss went up
+            scale = np.ones(k)
+            for j in range(30):
+                w_try = w.copy()
+                w_try[:,:,1:] -= scale[:,np.newaxis,np.newaxis] * step
+                loss_try, phi_try, logits_try = objective(w_try)
+                worse = loss_try > loss + 1e-10 * np.abs(loss)
+                if not np.any(worse):
+                    break
+                scale[worse] /= 2
+            
+            w, loss, phi, logits = w_try, loss_try, phi_try, logits_try
+            if np.max(np.abs(scale[:,np.newaxis,np.newaxis] * step)) < tol:
+                break
+        
+        if compHess:
+            _, H = gradHess(w,phi)
+            self.variance = np.array([variance_from_hessian(Hk) for Hk in H]) # kxd(c-1) variances of the weights
+        
+        # phi and the logits are only returned, not kept on the object, so no nxkxc tensor outlives the call
+        self.w = w
+        
+        return w, phi, logits
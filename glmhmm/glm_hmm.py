@@ -9,9 +9,11 @@ Created on Tue Oct 12 20:50:03 2021
 import numpy as np
 import autograd.numpy as npa
 from autograd import hessian
-from glmhmm.hmm import HMM
+from joblib import Parallel, delayed, effective_n_jobs
+from glmhmm.hmm import HMM, _forward_nb, _backward_nb, _forward_k2_nb, _backward_k2_nb
 from glmhmm.init_params import init_transitions, init_states, init_weights
 from glmhmm import glm
+from glmhmm.utils import variance_from_hessian
 
 class GLMHMM(HMM):
     
@@ -23,6 +25,8 @@ class GLMHMM(HMM):
         
         self.glm = glm.GLM(self.n,self.d,self.c,observations=observations)
         
+        self.logits = None # nxkxc matrix of wTx for every state, only cached while fitting
+        
     def generate_params(self,weights=['uniform',-1,1,1],transitions=['dirichlet',5,1],state_priors='uniform'):
         
         '''
@@ -73,61 +77,189 @@ class GLMHMM(HMM):
         '''
         
         zi = np.random.choice(np.arange(0,len(A)))  # randomly select initial state
-        y = np.zeros(self.n) 
         z = np.zeros(self.n)
-        phi = np.zeros((self.n,self.k,self.c))
         
         # generate inputs
-        x = np.random.randint(-10, high=10,size=(self.n,self.d)) # choose length random inputs between -10 and 10
+        x = np.random.randint(-10, high=10,size=(self.n,self.d)).astype(np.float64) # choose length random inputs between -10 and 10
+        
+        # compute phi for every state from weights up front (inputs don't depend on the latent states)
+        phi = self._compAllObs(x,w)
         
-        # generate observations and states using A and phi
+        # generate states using A, sampling z_{i+1} given z_i by inverting the cumulative transition probabilities
+        A_cum = np.cumsum(A,axis=1)
+        undist = np.random.rand(self.n) # generate set of uniformly distributed samples
         for i in range(self.n):
             z[i] = zi
-            
-            # compute phi for given state from weights 
-            phi = self.glm.observations.compObs(x[i,:],w[zi,:,:])
-            
-
-            # select z_{i+1} using z_i and A
-            zi = np.random.choice(A.shape[0], p = A[zi, :])
-            
-            # generate y's using probabilities from chosen latent state at each time point
-            y[i] = np.random.choice(self.c, p = phi)
+            zi = min(np.searchsorted(A_cum[zi],undist[i],side='right'),len(A)-1) # guard against rounding in A_cum[-1]
+        
+        # generate y's using probabilities from chosen latent state at each time point (states don't depend on the 
+        # observations, so these can all be drawn at once)
+        cumdist = np.cumsum(phi[np.arange(self.n),z.astype(int),:],axis=1) # calculate the cumulative distributions
+        undist = np.random.rand(self.n,1) # generate set of uniformly distributed samples
+        y = (undist < cumdist).argmax(axis=1).astype(float) # see where they "fit" in cumdist
         
         return y, z, x
     
+    def _compAllObs(self,x,w):
+        '''
+        Computes the observation probabilities for all states and time points at once. Equivalent to calling
+        compObs for every (time point, state) pair, but as a single batched matrix product and softmax.
+
+        Parameters
+        ----------
+        x : nxd matrix of inputs
+        w : kxdxc matrix of weights
+
+        Returns
+        -------
+        phi : nxkxc matrix of observation probabilities
+
+        '''
+        
+        logits = np.tensordot(x,w,axes=([1],[1])) # nxkxc matrix of wTx for every state
+        phi = np.exp(logits - logits.max(axis=2,keepdims=True)) # subtract max before exponentiating for stability
+        phi /= phi.sum(axis=2,keepdims=True) # normalize the exponentials 
+        
+        return phi
+    
+    def _compLogEmissionAtY(self,x,w,y,logits=None,out=None):
+        '''
+        Computes the log observation probabilities of the observed classes, log p(y_t|z_t), for all states and time 
+        points. This is all the E step needs, so the full nxkxc tensor is never kept; only its normalizer is reduced 
+        over. Working in log space means very unlikely observations don't underflow to zero.
+
+        Parameters
+        ----------
+        x : nxd matrix of inputs
+        w : kxdxc matrix of weights
+        y : nx1 vector of observations
+        logits : nxkxc matrix of wTx for every state, optional. Computed from x and w if not given.
+        out : nxk matrix, optional. If given, the result is written into it instead of a newly allocated array.
+
+        Returns
+        -------
+        log_py : nxk matrix of the log observation probabilities of the observed classes
+
+        '''
+        
+        if logits is None:
+            logits = np.tensordot(x,w,axes=([1],[1])) # nxkxc matrix of wTx for every state
+        m = logits.max(axis=2) # subtract max before exponentiating for stability
+        lognorm = m + np.log(np.sum(np.exp(logits - m[:,:,np.newaxis]),axis=2)) # log normalizer (logsumexp over classes)
+        log_py = np.subtract(logits[np.arange(y.shape[0]),:,y.astype(int)],lognorm,out=out)
+        
+        return log_py
+    
+    def _sumXis(self,alpha,beta,log_cs,A,log_py):
+        '''
+        Computes the joint posterior distribution of two successive latent variables p(z_{t-1},z_t|Y,theta_old),
+        summed over time (see Bishop Ch. 13). 
+
+        Parameters
+        ----------
+        alpha : nxk matrix of the conditional probabilities p(z_t|x_{1:t},y_{1:t})
+        beta : nxk matrix of the conditional probabilities p(y_{t+1:n}|z_t) (scaled by cs)
+        log_cs : nx1 vector of the log forward marginal likelihoods
+        A : kxk matrix of transition probabilities
+        log_py : nxk matrix of the log observation probabilities of the observed classes
+
+        Returns
+        -------
+        xis_n : kxk matrix of expected transition counts, sum_N xis
+
+        '''
+        
+        return A * (alpha[:-1].T @ (beta[1:] * np.exp(log_py[1:] - log_cs[1:,np.newaxis])))
+    
+    def _updateTransitions(self,y,alpha,beta,log_cs,A,log_py):
+        '''
+        Updates transition probabilities as part of the M-step of the EM algorithm. Same closed form update as the
+        HMM class, but computed from the observation probabilities of the observed classes.
+
+        Parameters
+        ----------
+        y : nx1 vector of observations
+        alpha : nxk matrix of the conditional probabilities p(z_t|x_{1:t},y_{1:t})
+        beta : nxk matrix of the conditional probabilities p(y_{t+1:n}|z_t) (scaled by cs)
+        log_cs : nx1 vector of the log forward marginal likelihoods
+        A : kxk matrix of transition probabilities
+        log_py : nxk matrix of the log observation probabilities of the observed classes
+
+        Returns
+        -------
+        A_new : kxk matrix of updated transition probabilities
+
+        '''
+        
+        xis_n = self._sumXis(alpha,beta,log_cs,A,log_py) # sum_N xis
+        A_new = xis_n/np.sum(xis_n,axis=1,keepdims=True) # normalize by sum_k sum_N xis
+        
+        return A_new
             
-    def _updateObservations(self,y,x,w,gammas):
+    def _updateObservations(self,y,x,w,gammas,certainty=0.99,sparseFrac=0,logits=None):
         '''
         Updates emissions probabilities as part of the M-step of the EM algorithm.
         For stationary observations, see the HMM class
-        Uses gradient descent to find optimal update of weights
+        Uses Newton's method (batched across states) to find optimal update of weights
         
         Parameters
         ----------
         y : nx1 vector of observations
         gammas : nxk matrix of the posterior probabilities of the latent states
+        certainty : float, optional. A time point counts as certain once its largest posterior state probability 
+            exceeds this value. The default is 0.99.
+        sparseFrac : float, optional. Once fewer than this fraction of time points are uncertain, each state's weights
+            are fit only to the time points where its posterior probability exceeds 1-certainty. This is faster late in
+            EM, but the dropped time points make the update approximate, so the loglikelihood is no longer guaranteed
+            to increase. The default is 0, which always fits every state to every time point.
+        logits : nxkxc matrix of wTx for the current weights, optional. Reused for the first Newton step instead of 
+            recomputing the products. The default is None.
         
         Returns
         -------
-        kxc matrix of updated emissions probabilities
+        w : kxdxc matrix of updated weights
+        log_py : nxk matrix of the updated log observation probabilities of the observed classes (reused by the next E step)
 
         '''
         
-        # reshape y from vector of indices to one-hot encoded array for matrix operations in glm.fit
-        yint = y.astype(int)
-        yy = np.zeros((yint.shape[0], yint.max()+1))
-        yy[np.arange(yint.shape[0]),yint] = 1
+        yint = y.astype(int) # glm.fitBatch gathers the observed class from each row using integer indices
         
-        self.phi = np.zeros((self.n,self.k,self.c))
-        
-        for zk in np.arange(self.k):
-            self.w[zk,:,:], self.phi[:,zk,:] = self.glm.fit(x,w[zk,:,:],yy,compHess=self.hessian,gammas=gammas[:,zk],gaussianPrior=self.gaussianPrior)
+        if np.mean(np.max(gammas,axis=1) < certainty) < sparseFrac:
+            # late in EM most posteriors are nearly one-hot, so most rows carry almost no weight for all but one state.
+            # fit each state to its own rows only, which visits about n rows in total instead of n for every state
+            w_new, variance = np.empty(w.shape), []
+            for zk in range(self.k):
+                rows = gammas[:,zk] > 1 - certainty
+                if not np.any(rows):
+                    # a collapsed state (e.g. when k is over-specified) has no data to fit, so keep its weights
+                    w_new[zk] = w[zk]
+                    if self.hessian:
+                        variance.append(np.full(self.d*(self.c-1),np.nan))
+                    continue
+                logits_k = None if logits is None else logits[rows,zk:zk+1]
+                w_new[zk:zk+1], _, _ = self.glm.fitBatch(x[rows],w[zk:zk+1],yint[rows],gammas[rows,zk:zk+1],compHess=self.hessian,gaussianPrior=self.gaussianPrior,logits=logits_k)
+                if self.hessian:
+                    variance.append(self.glm.variance[0])
+            if self.hessian:
+                self.glm.variance = np.array(variance)
+            
+            self.w = w_new
+            self.logits = np.tensordot(x,self.w,axes=([1],[1])) # each state was fit to a subset of rows only
+            self._compLogEmissionAtY(x,self.w,y,logits=self.logits,out=self.log_py)
+            
+        else:
+            # each state's weighted GLM is independent given the posteriors, so fit all states together with batched
+            # Newton steps
+            # the logits of the updated weights are cached for the next M step
+            self.w, _, self.logits = self.glm.fitBatch(x,w,yint,gammas,compHess=self.hessian,gaussianPrior=self.gaussianPrior,logits=logits)
             
+            # keep only the log probabilities of the observed classes, computed from the logits rather than log(phi) so 
+            # that very unlikely observations don't underflow to -inf
+            self._compLogEmissionAtY(x,self.w,y,logits=self.logits,out=self.log_py)
             
-        return self.w, self.phi
+        return self.w, self.log_py
     
-    def _updateParams(self,y,x,gammas,beta,alpha,cs,A,phi,w,fit_init_states = False):
+    def _updateParams(self,y,x,gammas,beta,alpha,log_cs,A,log_py,w,fit_init_states = False,certainty=0.99,sparseFrac=0):
         '''
         Computes the updated parameters as part of the M-step of the EM algorithm.
 
@@ -137,10 +269,11 @@ class GLMHMM(HMM):
         gammas : nxk matrix of the posterior probabilities of the latent states
         beta : nx1 vector of the conditional probabilities p(z_t|x_{1:t},y_{1:t})
         alpha : nx1 vector of the conditional probabilities p(z_t|x_{1:t},y_{1:t})
-        cs : nx1 vector of the forward marginal likelihoods
+        log_cs : nx1 vector of the log forward marginal likelihoods
         A : kxk matrix of transition probabilities
-        phi : kxc or nxkxc matrix of emission probabilities
+        log_py : nxk matrix of the log observation probabilities of the observed classes
         fit_init_states : boolean indicating whether initial state distribution is included as a learned parameter
+        certainty, sparseFrac : optional, see _updateObservations
 
         Returns
         -------
@@ -148,30 +281,81 @@ class GLMHMM(HMM):
 
         '''
         
-        A = self._updateTransitions(y,alpha,beta,cs,A,phi)
+        A = self._updateTransitions(y,alpha,beta,log_cs,A,log_py)
             
-        w, phi = self._updateObservations(y,x,w,gammas)
+        w, log_py = self._updateObservations(y,x,w,gammas,certainty=certainty,sparseFrac=sparseFrac,logits=self.logits)
         
         if fit_init_states: 
             self.pi0 = self._updateInitStates(gammas)
         
-        return A, w, phi, self.pi0
+        return A, w, log_py, self.pi0
+    
+    def _sessionEStep(self,A,log_py,pi0):
+        '''
+        Runs the forward and backward passes over a single session of data. Equivalent to forwardPass followed by 
+        backwardPass, but works directly on the observation probabilities of the observed classes.
+
+        Parameters
+        ----------
+        A : kxk matrix of transition probabilities
+        log_py : nxk matrix of the log observation probabilities of the observed classes for the session
+        pi0 : kx1 vector of state probabilities for t=1
+
+        Returns
+        -------
+        ll : float, marginal log-likelihood of the session
+        alpha : nxk matrix of the conditional probabilities p(z_t|x_{1:t},y_{1:t})
+        log_cs : nx1 vector of the log forward marginal likelihoods
+        pBack : nxk matrix of the posterior probabilities of the latent states
+        beta : nxk matrix of the conditional probabilities p(y_{t+1:n}|z_t) (scaled by cs)
+        zhatBack : nx1 vector of the most probable state at each time point
+
+        '''
+        
+        # if not fitting initial state probabilities, initialize to ones
+        if not np.any(pi0):
+            pi0 = np.ones(self.k)/self.k
+        
+        # two-state models (the most common case) get passes with the transition matvec written out
+        if self.k == 2:
+            forward, backward = _forward_k2_nb, _backward_k2_nb
+        else:
+            forward, backward = _forward_nb, _backward_nb
+        
+        # the compiled passes specialize on dtype and memory layout, so a float32, integer or Fortran-ordered A would 
+        # trigger a fresh compilation. as in HMM.forwardPass, cast to C-contiguous float64 (a no-op for the arrays the 
+        # M step returns)
+        A = np.ascontiguousarray(A,dtype=float)
+        pi0 = np.ascontiguousarray(np.ravel(pi0),dtype=float)
+        
+        alpha,log_cs,ll = forward(log_py,A,pi0)
+        pBack,beta = backward(log_py,A,alpha,log_cs)
+        zhatBack = np.argmax(pBack,axis=1) # decode from likelihoods only
+        
+        assert np.round(sum(pBack[0]),5) == 1, "Sum of posterior state probabilities does not equal 1"
+        
+        return ll,alpha,log_cs,pBack,beta,zhatBack
     
-    def fit(self,y,x,A,w,pi0=None,fit_init_states=False,maxiter=250,tol=1e-3,sess=None,B=1):
+    def fit(self,y,x,A,w,pi0=None,fit_init_states=False,maxiter=250,tol=1e-3,sess=None,B=1,certainty=0.99,sparseFrac=0):
         '''
 
         Parameters
         ----------
         y : nx1 vector of observations 
+        x : nxd matrix of inputs. Converted once to a C-contiguous float64 array (integer or strided inputs would 
+        otherwise be converted on every matrix product), so pass float64 data to avoid the copy
         A : initial kxk matrix of transition probabilities
-        phi : initial kxc or nxkxc matrix of emission probabilities
+        w : initial kxdxc matrix of weights
         pi0 : initial kx1 vector of state probabilities for t=1.
         fit_init_states : boolean, determines if EM will including fitting pi
         maxiter : int. The maximum number of iterations of EM to allow. The default is 250.
         tol : float. The tolerance value for the loglikelihood to allow early stopping of EM. The default is 1e-3.
         sessions : an optional vector of the first and last indices of different sessions in the data (for
         separate computations of the E step; first and last entries should be 0 and n, respectively)  
-        B : an optional temperature parameter used when fitting via direct annealing EM (DAEM; see Ueda and Nakano 1998)                                                                                         
+        B : an optional temperature parameter used when fitting via direct annealing EM (DAEM; see Ueda and Nakano 1998)
+        certainty, sparseFrac : optional, passed to _updateObservations. Setting sparseFrac > 0 fits each state's 
+        weights only to its confident time points once few time points are uncertain, which speeds up late iterations 
+        at the cost of an approximate M step. The default of 0 turns this off.                                                                                         
         Returns
         -------
         lls : vector of loglikelihoods for each step of EM, size maxiter 
@@ -183,56 +367,128 @@ class GLMHMM(HMM):
         
         lls = np.empty(maxiter)
         lls[:] = np.nan
+        
+        x = np.ascontiguousarray(x,dtype=np.float64) # cast inputs once so every product below stays on the BLAS path
             
         # store variables
         self.pi0 = pi0
         
-        # # compute phi for each state from weights 
-        phi = np.zeros((self.n,self.k,self.c))
-        for i in range(self.n):
-            for zi in range(self.k):
-                phi[i,zi,:] = self.glm.observations.compObs(x[i,:],w[zi,:,:])
+        # compute the log observation probabilities of the observed classes for each state from weights. allocated once 
+        # per fit (n can change between fits) and overwritten in place by _updateObservations on every iteration of EM.
+        # the logits (wTx for every state) are cached too, so each M step starts its first Newton step from them
+        # rather than recomputing the k products with x
+        self.logits = np.tensordot(x,w,axes=([1],[1]))
+        self.log_py = self._compLogEmissionAtY(x,w,y,logits=self.logits)
+        log_py = self.log_py
         
         if sess is None:
             sess = np.array([0,self.n]) # equivalent to saying the entire data set has one session
         
-        for n in range(maxiter):
+        # session boundaries don't change across iterations of EM, so build the slices once. row slices of the 
+        # C-contiguous nxk arrays below are contiguous views, so the compiled passes read them without copying
+        sess_slices = [slice(start,stop) for start,stop in zip(sess[:-1],sess[1:])]
+        
+        # sessions are independent chains and the compiled forward/backward passes release the GIL, so with several 
+        # cores the E step runs on a thread pool. the pool is created once for the whole fit, and each worker gets one 
+        # contiguous chunk of sessions per iteration (the per-session Python around the passes holds the GIL, so one
+        # task per session costs more in scheduling than it gains). with a single core the E step simply runs serially
+        n_workers = min(effective_n_jobs(-1),len(sess_slices))
+        chunks = [sess_slices[i[0]:i[-1]+1] for i in np.array_split(np.arange(len(sess_slices)),n_workers)]
+        
+        with Parallel(n_jobs=n_workers,prefer='threads') as parallel:
+            for n in range(maxiter):
             
-            # E STEP
-            alpha = np.zeros((self.n,self.k))
-            beta = np.zeros_like(alpha)
-            cs = np.zeros((self.n))
-            pBack = np.zeros_like(alpha)
-            zhatBack = np.zeros_like(cs)
-            ll = 0
+                # E STEP (buffers are filled session by session; sessions span 0 to n, so every entry is written)
+                alpha = np.empty((self.n,self.k))
+                beta = np.empty_like(alpha)
+                log_cs = np.empty((self.n))
+                pBack = np.empty_like(alpha)
+                zhatBack = np.empty_like(log_cs)
+                ll = 0
             
-            for s in range(len(sess)-1): # compute E step separately over each session or day of data 
-                ll_s,alpha_s,cs_s = self.forwardPass(y[sess[s]:sess[s+1]],A,phi[sess[s]:sess[s+1],:,:],pi0=pi0)
-                pBack_s,beta_s,zhatBack_s = self.backwardPass(y[sess[s]:sess[s+1]],A,phi[sess[s]:sess[s+1],:,:],alpha_s,cs_s)
-                
+                # compute E step separately over each session or day of data, one chunk of sessions per worker
+                estep = lambda chunk: [self._sessionEStep(A,log_py[s],pi0) for s in chunk]
+                if n_workers > 1:
+                    ests = [est for chunk_ests in parallel(delayed(estep)(chunk) for chunk in chunks) for est in chunk_ests]
+                else:
+                    ests = estep(sess_slices)
+            
+                for s, (ll_s,alpha_s,log_cs_s,pBack_s,beta_s,zhatBack_s) in zip(sess_slices,ests):
                 
-                ll += ll_s
-                alpha[sess[s]:sess[s+1]] = alpha_s
-                cs[sess[s]:sess[s+1]] = cs_s
-                pBack[sess[s]:sess[s+1]] = pBack_s ** B
-                beta[sess[s]:sess[s+1]] = beta_s
-                zhatBack[sess[s]:sess[s+1]] = zhatBack_s
+                    ll += ll_s
+                    alpha[s] = alpha_s
+                    log_cs[s] = log_cs_s
+                    pBack[s] = pBack_s ** B
+                    beta[s] = beta_s
+                    zhatBack[s] = zhatBack_s
                 
             
-            lls[n] = ll
+                lls[n] = ll
             
-            # M STEP
-            A,w,phi,pi0 = self._updateParams(y,x,pBack,beta,alpha,cs,A,phi,w,fit_init_states = fit_init_states)
+                # M STEP
+                A,w,log_py,pi0 = self._updateParams(y,x,pBack,beta,alpha,log_cs,A,log_py,w,fit_init_states = fit_init_states,certainty=certainty,sparseFrac=sparseFrac)
             
             
-            # CHECK FOR CONVERGENCE    
-            lls[n] = ll
-            if  n > 5 and lls[n-5] + tol >= ll: # break early if tolerance is reached
-                break
+                # CHECK FOR CONVERGENCE    
+                lls[n] = ll
+                if  n > 5 and lls[n-5] + tol >= ll: # break early if tolerance is reached
+                    break
+        
+        self.logits = None # release the nxkxc cache; it is only needed between iterations of EM
         
         return lls,A,w,pi0
     
-    def computeVariance(self,x,y,A,w,gaussPrior=0):
+    def _hessianBlocks(self,x,y,A,w,gaussPrior=0):
+        
+        '''
+        Computes the closed-form Hessian of the posterior-weighted (complete-data) negative loglikelihood of a GLM-HMM. 
+        Under this approximation the Hessian is block diagonal, with one block for the free entries of each row of A
+        and one block for the weights of each state. Uses the same parameterization as computeVariance. The 
+        complete-data Hessian overstates the information in the data, so variances computed from it are too small.
+        
+        Parameters
+        ----------
+        x : nxd matrix of inputs
+        y : nx1 vector of observations
+        A : fitted kxk matrix of transition probabilities
+        w : fitted kxdx(c-1) matrix of weights (the last class is the reference class)
+        gaussPrior : sigma of the Gaussian prior on the weights. The default is 0 which corresponds to no prior.
+
+        Returns
+        -------
+        blocks : list of the k (k-1)x(k-1) transition blocks followed by the k d(c-1)xd(c-1) weight blocks
+
+        '''
+        
+        # observation probabilities with a zero weight vector appended for the reference class
+        w_full = np.concatenate((w,np.zeros((self.k,self.d,1))),axis=2)
+        phi = self._compAllObs(x,w_full)
+        
+        # posterior state probabilities and expected transition counts sum_t p(z_t,z_{t+1}|y). log_py is computed in
+        # log space rather than as log(phi) so that very unlikely observations don't underflow to -inf
+        log_py = self._compLogEmissionAtY(x,w_full,y)
+        _,alpha,log_cs,pBack,beta,_ = self._sessionEStep(A,log_py,None)
+        xis = self._sumXis(alpha,beta,log_cs,A,log_py)
+        
+        blocks = []
+        
+        # transition blocks: the last entry of each row of A is 1 - sum(other entries)
+        for i in range(self.k):
+            H = np.diag(xis[i,:-1]/A[i,:-1]**2) + xis[i,-1]/A[i,-1]**2
+            blocks.append(H)
+        
+        # weight blocks: posterior-weighted multinomial-logit Hessian, sum_t gamma_t (diag(p_t) - p_t p_t^T) kron x_t x_t^T
+        for zk in range(self.k):
+            p = phi[:,zk,:-1]
+            S = pBack[:,zk,np.newaxis,np.newaxis] * (p[:,:,np.newaxis] * np.eye(self.c-1) - p[:,:,np.newaxis] * p[:,np.newaxis,:])
+            H = np.einsum('ni,nj,nab->iajb',x,x,S,optimize=True).reshape((self.d*(self.c-1),self.d*(self.c-1)))
+            if gaussPrior:
+                H += np.eye(self.d*(self.c-1)) / gaussPrior**2 # Hessian of the Gaussian prior
+            blocks.append(H)
+        
+        return blocks
+    
+    def computeVariance(self,x,y,A,w,gaussPrior=0,method='autograd'):
         
         '''
         Compute the variance for the fitted parameters A and w of a GLM-HMM
@@ -245,12 +501,31 @@ class GLMHMM(HMM):
         w : fitted kxdxc omatrix of weights
         gaussPrior : integer specifying the sigma of a desired Gaussian prior on the loss to penalize large
         weight values. The default is 0 which corresponds to no prior.
+        method : string, optional
+            'autograd' differentiates the marginal loglikelihood through the forward pass, giving the exact Hessian
+            (including cross-terms between parameters), but scales poorly with the number of parameters. 'analytic' 
+            inverts the closed-form, block-diagonal Hessian of the posterior-weighted (complete-data) loglikelihood 
+            (see _hessianBlocks), one small block at a time. This is much faster, but it leaves out the information 
+            lost to not observing the latent states, so it is a lower bound that understates the variances. The 
+            default is 'autograd'.
 
         Returns
         -------
         variance : a vector containing the variances for the fitted parameters A and w
 
         '''
+        
+        method_list = {'analytic','autograd'}
+        if method not in method_list:
+            raise Exception("Invalid method: {}. Must be one of {}".
+                format(method, method_list))
+            
+        if method == 'analytic':
+            ## calculate variance of parameters from each block of the Hessian
+            blocks = self._hessianBlocks(x,y,A,w,gaussPrior=gaussPrior)
+            variance = np.hstack([variance_from_hessian(H) for H in blocks])
+            
+            return variance
 
         def logLikelihood(params_flat,y,x):
     
@@ -264,29 +539,26 @@ class GLMHMM(HMM):
            w = params_flat[int(self.k * (self.k-1)):]
            w = npa.reshape(w,(self.k,self.d,self.c-1))
     
-           phi = [] # must use list appending because autograd numpy doesn't support indexing
-    
-           for zi in range(self.k):
-               w_new = npa.reshape(w[zi,:,:],(self.d,self.c-1))
-               p = npa.exp(x@w_new) # get exponentials e^wTx
-               p = npa.hstack((p,npa.ones((len(p),1))))
-               norm = npa.sum(p,axis=1) # get normalization constant (sum of exponentials)
-               phi.append(npa.divide(p.T,norm).T) # normalize the exponentials
-    
-           phi = npa.array(phi)
+           # compute phi for all states in one op so the autograd tape stays short
+           p = npa.exp(npa.einsum('nd,kdc->nkc',x,w)) # get exponentials e^wTx
+           p = npa.concatenate((p,npa.ones((self.n,self.k,1))),axis=2)
+           phi = p / npa.sum(p,axis=2,keepdims=True) # normalize the exponentials
+           
+           # gather the probabilities of the observed classes once, outside of the forward loop
+           phi_y = phi[np.arange(self.n),:,y.astype(int)]
               
            aa = [] # forward probabilities p(z_t | x_1:t)
            cs = [] # forward marginal likelihoods
     
            # first time bin
-           pxz = phi[:,0,int(y[0])]
+           pxz = phi_y[0]
            cs.append(npa.sum(pxz)) # normalizer
            aa.append(pxz/cs[0]) # conditional p(z_1 | x_1)
     
            # forward pass for remaining time bins
            for i in npa.arange(1,self.n):
                aaprior = npa.dot(aa[i-1],A) # propogate uncertainty forward
-               pxz = npa.multiply(phi[:,i,int(y[i])],aaprior) # joint P(x_1:t,z_t)
+               pxz = npa.multiply(phi_y[i],aaprior) # joint P(x_1:t,z_t)
                cs.append(npa.sum(pxz)) # conditional p(x_t | x_1:t-1)
                aa.append(pxz/cs[i]) # conditional p(z_t | x_1:t)
     
@@ -306,6 +578,6 @@ class GLMHMM(HMM):
         H = hess(params_flat) # get hessian matrix
     
         ## calculate variance of parameters from Hessian
-        variance = np.sqrt(np.diag(np.linalg.inv(H)))
+        variance = variance_from_hessian(H)
        
         return variance
\ No newline at end of file
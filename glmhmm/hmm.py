@@ -12,8 +12,160 @@ Updated: Sep 1, 2020
 """
 
 import numpy as np
+from numba import njit
 from glmhmm.init_params import init_transitions, init_emissions, init_states
 
+# fast-math flags that allow reordering arithmetic but, unlike fastmath=True, keep IEEE inf handling (log emission
+# probabilities can be -inf)
+_FASTMATH = {'nsz','arcp','contract','reassoc'}
+
+@njit(cache=True,fastmath=_FASTMATH,nogil=True)
+def _forward_nb(log_py,A,pi0):
+    """
+    Compiled forward recursion shared by HMM.forwardPass and its subclasses. Emissions and normalizers are kept in
+    log space: each time bin's emissions are shifted by their max before exponentiating, so a bin where every state
+    underflows p(y_t|z_t) still normalizes, and the shift is folded back into the log normalizer.
+
+    Parameters
+    ----------
+    log_py : nxk matrix of the log emission probabilities of the observed classes, log p(y_t|z_t)
+    A : kxk matrix of transition probabilities
+    pi0 : kx1 vector of state probabilities for t=1
+
+    Returns
+    -------
+    alpha : nxk matrix of the conditional probabilities p(z_t|x_{1:t},y_{1:t})
+    log_cs : nx1 vector of the log forward marginal likelihoods
+    ll : float, marginal log-likelihood of the data p(y)
+    """
+    
+    n, k = log_py.shape
+    alpha = np.empty((n,k))
+    log_cs = np.empty(n)
+    
+    # forward pass; transition matvec written out so it compiles to a tight loop
+    for t in range(n):
+        m = log_py[t,0]
+        for j in range(1,k):
+            m = max(m,log_py[t,j])
+        norm = 0.
+        for j in range(k):
+            if t == 0:
+                alpha_prior = pi0[j] # weight t=0 observation probabilities by initial state probabilities
+            else:
+                alpha_prior = 0.
+                for i in range(k):
+                    alpha_prior += alpha[t-1,i] * A[i,j] # propogate uncertainty forward
+            alpha[t,j] = np.exp(log_py[t,j] - m) * alpha_prior # joint P(y_1:t,z_t), up to the shift m
+            norm += alpha[t,j]
+        scale = 1. / norm
+        for j in range(k):
+            alpha[t,j] *= scale # conditional p(z_t | y_1:t)
+        log_cs[t] = np.log(norm) + m # conditional log p(y_t | y_1:t-1)
+    
+    ll = np.sum(log_cs)
+    
+    return alpha, log_cs, ll
+
+@njit(cache=True,fastmath=_FASTMATH,nogil=True)
+def _backward_nb(log_py,A,alpha,log_cs):
+    """
+    Compiled backward recursion shared by HMM.backwardPass and its subclasses.
+
+    Parameters
+    ----------
+    log_py : nxk matrix of the log emission probabilities of the observed classes, log p(y_t|z_t)
+    A : kxk matrix of transition probabilities
+    alpha : nxk matrix of the conditional probabilities p(z_t|x_{1:t},y_{1:t})
+    log_cs : nx1 vector of the log forward marginal likelihoods
+
+    Returns
+    -------
+    pBack : nxk matrix of the posterior probabilities of the latent states
+    beta : nxk matrix of the conditional probabilities p(y_{t+1:n}|z_t) (scaled by cs)
+    """
+    
+    n, k = log_py.shape
+    beta = np.empty((n,k))
+    beta_prior = np.empty(k)
+    
+    # last time bin
+    for j in range(k):
+        beta[n-1,j] = 1. # take beta(z_N) = 1
+    
+    # backward pass for remaining time bins
+    for t in range(n-2,-1,-1):
+        for j in range(k):
+            beta_prior[j] = beta[t+1,j] * np.exp(log_py[t+1,j] - log_cs[t+1]) # propogate uncertainty backward
+        for i in range(k):
+            b = 0.
+            for j in range(k):
+                b += A[i,j] * beta_prior[j]
+            beta[t,i] = b
+    
+    pBack = alpha * beta # posterior after backward pass -> alpha_hat(z_n)*beta_hat(z_n)
+    
+    return pBack, beta
+
+@njit(cache=True,fastmath=_FASTMATH,nogil=True)
+def _forward_k2_nb(log_py,A,pi0):
+    """
+    Forward recursion specialized for two states; same inputs and outputs as _forward_nb. The transition matvec is 
+    written out with the entries of A and the previous alpha held in scalars across time bins.
+    """
+    
+    n = log_py.shape[0]
+    alpha = np.empty((n,2))
+    log_cs = np.empty(n)
+    A00, A01, A10, A11 = A[0,0], A[0,1], A[1,0], A[1,1]
+    
+    prior0, prior1 = pi0[0], pi0[1] # weight t=0 observation probabilities by initial state probabilities
+    for t in range(n):
+        m = max(log_py[t,0],log_py[t,1])
+        a0 = np.exp(log_py[t,0] - m) * prior0 # joint P(y_1:t,z_t), up to the shift m
+        a1 = np.exp(log_py[t,1] - m) * prior1
+        norm = a0 + a1
+        scale = 1. / norm
+        a0 *= scale # conditional p(z_t | y_1:t)
+        a1 *= scale
+        alpha[t,0] = a0
+        alpha[t,1] = a1
+        log_cs[t] = np.log(norm) + m # conditional log p(y_t | y_1:t-1)
+        prior0 = a0 * A00 + a1 * A10 # propogate uncertainty forward
+        prior1 = a0 * A01 + a1 * A11
+    
+    ll = np.sum(log_cs)
+    
+    return alpha, log_cs, ll
+
+@njit(cache=True,fastmath=_FASTMATH,nogil=True)
+def _backward_k2_nb(log_py,A,alpha,log_cs):
+    """
+    Backward recursion specialized for two states; same inputs and outputs as _backward_nb.
+    """
+    
+    n = log_py.shape[0]
+    beta = np.empty((n,2))
+    A00, A01, A10, A11 = A[0,0], A[0,1], A[1,0], A[1,1]
+    
+    # last time bin
+    b0, b1 = 1., 1. # take beta(z_N) = 1
+    beta[n-1,0] = b0
+    beta[n-1,1] = b1
+    
+    # backward pass for remaining time bins
+    for t in range(n-2,-1,-1):
+        q0 = b0 * np.exp(log_py[t+1,0] - log_cs[t+1]) # propogate uncertainty backward
+        q1 = b1 * np.exp(log_py[t+1,1] - log_cs[t+1])
+        b0 = A00 * q0 + A01 * q1
+        b1 = A10 * q0 + A11 * q1
+        beta[t,0] = b0
+        beta[t,1] = b1
+    
+    pBack = alpha * beta # posterior after backward pass -> alpha_hat(z_n)*beta_hat(z_n)
+    
+    return pBack, beta
+
 class HMM(object):
 
     """
@@ -119,9 +271,6 @@ class HMM(object):
 
         '''
         
-        alpha = np.zeros((y.shape[0],self.k)) # forward probabilities p(z_t | x_1:t)
-        cs = np.zeros(y.shape[0]) # forward marginal likelihoods
-        
         # if not fitting initial state probabilities, initialize to ones
         if not np.any(pi0):
             pi0 = np.ones(self.k)/self.k
@@ -132,21 +281,12 @@ class HMM(object):
         elif len(phi.shape) == 3:
             phir = phi
         
-        # first time bin
-        pxz = np.multiply(phir[0,:,int(y[0])],np.squeeze(pi0)) # weight t=0 observation probabilities by initial state probabilities
-        cs[0] = np.sum(pxz) # normalizer
-        alpha[0] = pxz/cs[0] # conditional p(z_1 | x_1)
-    
-        # forward pass for remaining time bins
-        for i in np.arange(1,y.shape[0]):
-            alpha_prior = alpha[i-1]@A # propogate uncertainty forward
-            pxz = np.multiply(phir[i,:,int(y[i])],alpha_prior) # joint P(y_1:t,z_t)
-            cs[i] = np.sum(pxz) # conditional p(y_t | y_1:t-1)
-            alpha[i] = pxz/cs[i] # conditional p(z_t | y_1:t)
+        # gather the log emission probabilities of the observed classes into a contiguous nxk array for the compiled pass
+        log_py = np.log(np.ascontiguousarray(phir[np.arange(y.shape[0]),:,y.astype(int)],dtype=float))
         
-        ll = np.sum(np.log(cs))
+        alpha,log_cs,ll = _forward_nb(log_py,np.ascontiguousarray(A,dtype=float),np.ascontiguousarray(np.ravel(pi0),dtype=float))
         
-        return ll,alpha,cs
+        return ll,alpha,np.exp(log_cs)
         
     
     def backwardPass(self,y,A,phi,alpha,cs):
@@ -170,17 +310,10 @@ class HMM(object):
 
         '''
         
-        beta = np.zeros((y.shape[0],self.k))
+        # gather the log emission probabilities of the observed classes into a contiguous nxk array for the compiled pass
+        log_py = np.log(np.ascontiguousarray(phi[np.arange(y.shape[0]),:,y.astype(int)],dtype=float))
         
-        # last time bin
-        beta[-1] = 1 # take beta(z_N) = 1
-        
-        # backward pass for remaining time bins
-        for i in np.arange(y.shape[0]-2,-1,-1):
-            beta_prior = np.multiply(beta[i+1],phi[i+1,:,int(y[i+1])]) # propogate uncertainty backward
-            beta[i] = (A@beta_prior)/cs[i+1]
-            
-        pBack = np.multiply(alpha,beta) # posterior after backward pass -> alpha_hat(z_n)*beta_hat(z_n)
+        pBack,beta = _backward_nb(log_py,np.ascontiguousarray(A,dtype=float),np.ascontiguousarray(alpha),np.log(cs))
         zhatBack = np.argmax(pBack,axis=1) # decode from likelihoods only
         
         assert np.round(sum(pBack[0]),5) == 1, "Sum of posterior state probabilities does not equal 1"
@@ -335,12 +468,12 @@ class HMM(object):
                 phi = phi[np.newaxis,:,:] # add axis along n dim
                 phi = np.tile(phi, (self.n,1,1)) # stack matrix n times
             
-            # E STEP
-            alpha = np.zeros((self.n,self.k))
-            beta = np.zeros_like(alpha)
-            cs = np.zeros((self.n))
-            pBack = np.zeros_like(alpha)
-            zhatBack = np.zeros_like(cs)
+            # E STEP (buffers are filled session by session; sessions span 0 to n, so every entry is written)
+            alpha = np.empty((self.n,self.k))
+            beta = np.empty_like(alpha)
+            cs = np.empty((self.n))
+            pBack = np.empty_like(alpha)
+            zhatBack = np.empty_like(cs)
             ll = 0
             
             for s in range(len(sess)-1): # compute E step separately over each session or day of data 
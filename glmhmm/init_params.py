@@ -153,12 +153,9 @@ def init_weights(self,distribution='uniform',params=None,bias=True):
         w = np.random.uniform(params[0],high=params[1],size=(self.d,self.c-1))
         self.w = np.hstack((np.zeros((self.d,1)),w)) # add vector of zeros to weights
         
-        # reshape y from vector of indices to one-hot encoded array for matrix operations in glm.fit
-        yint = params[3].astype(int)
-        yy = np.zeros((yint.shape[0], yint.max()+1))
-        yy[np.arange(yint.shape[0]),yint] = 1
+        yint = params[3].astype(int) # glm.fit gathers the observed class from each row using integer indices
         
-        w, phi = self.glm.fit(params[2],self.w,yy,compHess=False,gammas=None,gaussianPrior=0)
+        w, phi = self.glm.fit(params[2],self.w,yint,compHess=False,gammas=None,gaussianPrior=0)
         
         wk = np.zeros((self.k,self.d,self.c))
         for zi in range(self.k):
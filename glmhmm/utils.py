@@ -10,6 +10,7 @@ Miscellaneous helper functions for fitting and analyzing GLM/HMM code
 """
 
 import numpy as np
+from scipy.linalg import cho_factor, solve_triangular
 
 def permute_states(M,method='self-transitions',param='transitions',order=None,ix=None):
     
@@ -81,6 +82,30 @@ def permute_states(M,method='self-transitions',param='transitions',order=None,ix
     return M_perm, order 
 
 
+def variance_from_hessian(H):
+    '''
+    Computes the variances sqrt(diag(H^-1)) of fitted parameters from the Hessian of the negative loglikelihood,
+    without forming the inverse. With the Cholesky factor H = LL^T, diag(H^-1)_i is the squared norm of the ith 
+    column of L^-1. Falls back to the pseudo-inverse if H is not positive definite.
+
+    Parameters
+    ----------
+    H : pxp Hessian matrix 
+
+    Returns
+    -------
+    variance : px1 vector of the variances of the parameters
+    '''
+    
+    try:
+        L, _ = cho_factor(H,lower=True)
+    except np.linalg.LinAlgError:
+        return np.sqrt(np.diag(np.linalg.pinv(H)))
+    
+    Linv = solve_triangular(L,np.eye(H.shape[0]),lower=True)
+    
+    return np.sqrt(np.sum(Linv**2,axis=0))
+
 def find_best_fit(lls):
 
     return np.argmax(np.nanmax(lls,axis=1))